@@ -1,9 +1,15 @@
 import hashlib
 import json
+import mmap
 import os
+import sys
+import tempfile
 import threading
-from pathlib import Path
-from typing import List
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Dict, Iterator, List
 
 import yara
 
@@ -13,8 +19,86 @@ from assemblyline.common.str_utils import safe_str
 from assemblyline_v4_service.common.base import ServiceBase
 from assemblyline_v4_service.common.result import Result, ResultSection, BODY_FORMAT
 
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _json_dumps = json.dumps
+
 Classification = forge.get_classification()
 FILE_UPDATE_DIRECTORY = os.environ.get('FILE_UPDATE_DIRECTORY', "/mount/updates/")
+COMPILED_RULES_EXTENSION = '.yarac'
+DEFAULT_FAST_MODE_THRESHOLD = 100 * 1024 * 1024
+DEFAULT_SCAN_TIMEOUT = 50
+# 4 times the YARA defaults
+DEFAULT_MAX_STRINGS_PER_RULE = 40000
+DEFAULT_STACK_SIZE = 65536
+
+# Task currently being scanned by the calling thread
+_current_task: ContextVar = ContextVar('task', default=None)
+
+
+# Metadata values such as categories, classifications and malware names come from a small vocabulary, so their
+# normalized form is cached and interned instead of being rebuilt for every match
+@lru_cache(maxsize=2048)
+def _lower(value: str) -> str:
+    return sys.intern(value.lower())
+
+
+@lru_cache(maxsize=2048)
+def _upper(value: str) -> str:
+    return sys.intern(value.upper())
+
+
+@lru_cache(maxsize=2048)
+def _stripped_upper(value: str) -> str:
+    return sys.intern(value.strip().upper())
+
+
+def _scan_files(directory: str) -> Iterator[os.DirEntry]:
+    """
+    Recursively list the files of a directory using a single scandir call per directory.
+
+    Args:
+        directory: Directory to list.
+
+    Returns:
+        Directory entries of the files found.
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield from _scan_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+@contextmanager
+def _map_file(file_path: str):
+    """
+    Open a file once and expose its content as a read-only memory map so that it can be scanned several times
+    without reading it again. Empty files cannot be memory mapped and are returned as empty bytes.
+
+    Args:
+        file_path: Path of the file to map.
+
+    Returns:
+        Read-only bytes-like object with the file content.
+    """
+    with open(file_path, 'rb') as fh:
+        if not os.fstat(fh.fileno()).st_size:
+            yield b''
+            return
+
+        file_data = mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ)
+        try:
+            if hasattr(file_data, 'madvise'):
+                file_data.madvise(mmap.MADV_SEQUENTIAL)
+            yield file_data
+        finally:
+            file_data.close()
 
 
 class YaraMetadata(object):
@@ -30,7 +114,7 @@ class YaraMetadata(object):
         meta = match.meta
         self.name = match.rule
         self.id = meta.get('id', meta.get('rule_id', meta.get('signature_id', None)))
-        self.category = meta.get('category', meta.get('rule_group', 'info')).lower()
+        self.category = _lower(meta.get('category', meta.get('rule_group', 'info')))
         self.malware_type = meta.get('malware_type', None)
         self.version = meta.get('version', meta.get('rule_version', meta.get('revision', 1)))
         self.description = meta.get('description', None)
@@ -46,79 +130,46 @@ class YaraMetadata(object):
         self.exploit = meta.get('exploit', None)
         self.al_tag = meta.get('al_tag', None)
 
-        def _set_default_attack_id(key):
-            if self.mitre_att:
-                return self.mitre_att
-            if key in self.MITRE_ATT_DEFAULTS:
-                return self.MITRE_ATT_DEFAULTS[key]
-            return None
-
-        def _safe_split(comma_sep_list):
-            if comma_sep_list is None:
-                return []
-            return [e for e in comma_sep_list.split(',') if e]
-
         # Specifics about the category
         self.info = meta.get('info', None)
         self.technique = meta.get('technique', None)
-        self.exploit = meta.get('exploit', None)
         self.tool = meta.get('tool', None)
         self.malware = meta.get('malware', meta.get('implant', None))
 
-        self.actors = _safe_split(self.actor)
-        self.behavior = set(_safe_split(meta.get('summary', None)))
-        self.exploits = _safe_split(self.exploit)
+        self.actors = self._safe_split(self.actor)
+        self.behavior = set(self._safe_split(meta.get('summary', None)))
+        self.exploits = self._safe_split(self.exploit)
 
         # Parse and populate tag list
         self.tags = []
         if self.al_tag:
-            if ',' in self.malware:
-                for al_tag in self.al_tag.split(','):
-                    tokens = al_tag.split(':')
-                    if len(tokens) == 2:
-                        self.tags.append({"type": tokens[0], 'value': tokens[1]})
-
-            else:
-                tokens = self.al_tag.split(':')
+            for al_tag in self.al_tag.split(','):
+                tokens = al_tag.split(':')
                 if len(tokens) == 2:
                     self.tags.append({"type": tokens[0], 'value': tokens[1]})
 
         # Parse and populate malware list
         self.malwares = []
         if self.malware:
-            if ',' in self.malware:
-                for malware in self.malware.split(','):
-                    tokens = malware.split(':')
-                    malware_name = tokens[0]
-                    malware_family = tokens[1] if (len(tokens) == 2) else ''
-                    self.malwares.append((malware_name.strip().upper(), malware_family.strip().upper()))
-            else:
-                tokens = self.malware.split(':')
+            malwares = self.malware.split(',')
+            # The malware type is only used as the family of a rule that names a single malware
+            default_family = (self.malware_type or '') if len(malwares) == 1 else ''
+            for malware in malwares:
+                tokens = malware.split(':')
                 malware_name = tokens[0]
-                malware_family = tokens[1] if (len(tokens) == 2) else self.malware_type or ''
-                self.malwares.append((malware_name.strip().upper(), malware_family.strip().upper()))
+                malware_family = tokens[1] if (len(tokens) == 2) else default_family
+                self.malwares.append((_stripped_upper(malware_name), _stripped_upper(malware_family)))
 
         # Parse and populate technique info
         self.techniques = []
         if self.technique:
-            if ',' in self.technique:
-                for technique in self.technique.split(','):
-                    tokens = technique.split(':')
-                    category = ''
-                    if len(tokens) == 2:
-                        category = tokens[0]
-                        name = tokens[1]
-                        self.mitre_att = _set_default_attack_id(category)
-                    else:
-                        name = tokens[0]
-                    self.techniques.append((category.strip(), name.strip()))
-            else:
-                tokens = self.technique.split(':')
+            for technique in self.technique.split(','):
+                tokens = technique.split(':')
                 category = ''
                 if len(tokens) == 2:
                     category = tokens[0]
                     name = tokens[1]
-                    self.mitre_att = _set_default_attack_id(category)
+                    self.mitre_att = self._set_default_attack_id(category)
                 else:
                     name = tokens[0]
                 self.techniques.append((category.strip(), name.strip()))
@@ -126,22 +177,25 @@ class YaraMetadata(object):
         # Parse and populate info
         self.infos = []
         if self.info:
-            if ',' in self.info:
-                for info in self.info.split(','):
-                    tokens = info.split(':', 1)
-                    if len(tokens) == 2:
-                        # category, value
-                        self.infos.append((tokens[0], tokens[1]))
-                    else:
-                        self.infos.append((None, tokens[0]))
-            else:
-                tokens = self.info.split(':', 1)
+            for info in self.info.split(','):
+                tokens = info.split(':', 1)
                 if len(tokens) == 2:
                     # category, value
                     self.infos.append((tokens[0], tokens[1]))
                 else:
                     self.infos.append((None, tokens[0]))
 
+    def _set_default_attack_id(self, key):
+        if self.mitre_att:
+            return self.mitre_att
+        return self.MITRE_ATT_DEFAULTS.get(key, None)
+
+    @staticmethod
+    def _safe_split(comma_sep_list):
+        if not comma_sep_list:
+            return []
+        return [e for e in comma_sep_list.split(',') if e]
+
 
 class Yara(ServiceBase):
     TECHNIQUE_DESCRIPTORS = dict(
@@ -161,6 +215,9 @@ class Yara(ServiceBase):
 
     )
 
+    # Maximum number of rule matches reported for a single file
+    MAX_MATCHES = 10000
+
     YARA_HEURISTICS_MAP = dict(
         info=1,
         technique=2,
@@ -194,84 +251,94 @@ class Yara(ServiceBase):
         self.initialization_lock = threading.RLock()
         self.rules = None
         self.rules_list = []
-        self.deep_scan = None
+        self.rules_directory = None
+        self.yara_config = {}
 
         # Load rules and externals
         self.rules_hash = self._get_rules_hash()
         self.yara_externals = {f'al_{x.replace(".", "_")}': "" for x in externals}
 
-    def _add_resultinfo_for_match(self, result: Result, match):
+    def _build_section_for_match(self, match) -> ResultSection:
         """
-        Parse from Yara signature match and add information to the overall AL service result. This module determines
+        Parse from Yara signature match and build the AL result section for it. This module determines
         result score and identifies any AL tags that should be added (i.e. IMPLANT_NAME, THREAT_ACTOR, etc.).
 
         Args:
-            result: AL ResultSection object.
             match: Yara rules Match object item.
 
         Returns:
-            None.
+            AL ResultSection object.
         """
         almeta = YaraMetadata(match)
         self._normalize_metadata(almeta)
 
         section = ResultSection('', classification=almeta.classification)
-        if self.deep_scan or almeta.al_status != "NOISY":
+        # ResultSection has no bulk tagging API, bind the method once since it is called for every tag of every match
+        add_tag = section.add_tag
+        task = _current_task.get()
+        if (task is not None and task.deep_scan) or almeta.al_status != "NOISY":
             section.set_heuristic(self.YARA_HEURISTICS_MAP.get(almeta.category, 1),
                                   signature=f'{match.namespace}.{match.rule}', attack_id=almeta.mitre_att)
-        section.add_tag(f'file.rule.{self.name.lower()}', f'{match.namespace}.{match.rule}')
+        add_tag(f'file.rule.{self.name.lower()}', f'{match.namespace}.{match.rule}')
 
         title_elements = [f"[{match.namespace}] {match.rule}", ]
+        add_title_element = title_elements.append
+        behavior = almeta.behavior
+        add_behavior = behavior.add
+        exploits = almeta.exploits
 
         if almeta.actor_type:
-            section.add_tag('attribution.actor', almeta.actor_type)
+            add_tag('attribution.actor', almeta.actor_type)
 
         for tag in almeta.tags:
-            section.add_tag(tag['type'], tag['value'])
+            add_tag(tag['type'], tag['value'])
 
         # Malware Tags
         implant_title_elements = []
+        add_implant_title_element = implant_title_elements.append
         for (implant_name, implant_family) in almeta.malwares:
             if implant_name:
-                implant_title_elements.append(implant_name)
-                section.add_tag('attribution.implant', implant_name)
+                add_implant_title_element(implant_name)
+                add_tag('attribution.implant', implant_name)
             if implant_family:
-                implant_title_elements.append(implant_family)
-                section.add_tag('attribution.family', implant_family)
+                add_implant_title_element(implant_family)
+                add_tag('attribution.family', implant_family)
         if implant_title_elements:
-            title_elements.append(f"- Implant(s): {', '.join(implant_title_elements)}")
+            add_title_element(f"- Implant(s): {', '.join(implant_title_elements)}")
 
         # Threat Actor metadata
         for actor in almeta.actors:
-            title_elements.append(actor)
-            section.add_tag('attribution.actor', actor)
+            add_title_element(actor)
+            add_tag('attribution.actor', actor)
 
         # Exploit / CVE metadata
-        if almeta.exploits:
-            title_elements.append(f"- Exploit(s): {', '.join(almeta.exploits)}")
-        for exploit in almeta.exploits:
-            section.add_tag('attribution.exploit', exploit)
+        if exploits:
+            add_title_element(f"- Exploit(s): {', '.join(exploits)}")
+        for exploit in exploits:
+            add_tag('attribution.exploit', exploit)
 
         # Include technique descriptions in the section behavior
+        get_technique_descriptor = self.TECHNIQUE_DESCRIPTORS.get
         for (category, name) in almeta.techniques:
-            descriptor = self.TECHNIQUE_DESCRIPTORS.get(category, None)
+            descriptor = get_technique_descriptor(category, None)
             if descriptor:
                 technique_type, technique_description = descriptor
-                section.add_tag(technique_type, name)
-                almeta.behavior.add(technique_description)
+                add_tag(technique_type, name)
+                add_behavior(technique_description)
 
+        get_info_descriptor = self.INFO_DESCRIPTORS.get
         for (category, name) in almeta.infos:
-            descriptor = self.INFO_DESCRIPTORS.get(category, None)
+            descriptor = get_info_descriptor(category, None)
             if descriptor:
                 info_type, info_description = descriptor
-                section.add_tag(info_type, name)
-                almeta.behavior.add(info_description)
+                add_tag(info_type, name)
+                add_behavior(info_description)
 
         # Summaries
-        if almeta.behavior:
-            title_elements.append(f"- Behavior: {', '.join(almeta.behavior)}")
-        for element in almeta.behavior:
-            section.add_tag('file.behavior', element)
+        if behavior:
+            add_title_element(f"- Behavior: {', '.join(behavior)}")
+        for element in behavior:
+            add_tag('file.behavior', element)
 
         title = " ".join(title_elements)
         section.title_text = title
@@ -286,14 +353,14 @@ class Yara(ServiceBase):
             if val:
                 json_body[item] = val
 
-        string_match_data = self._add_string_match_data(match)
+        # Rules matching on their condition only have no string hits to report
+        string_match_data = self._add_string_match_data(match) if match.strings else None
         if string_match_data:
             json_body['string_hits'] = string_match_data
 
-        section.set_body(json.dumps(json_body), body_format=BODY_FORMAT.KEY_VALUE)
+        section.set_body(_json_dumps(json_body), body_format=BODY_FORMAT.KEY_VALUE)
 
-        result.add_section(section)
-        # result.order_results_by_score() TODO: should v4 support this?
+        return section
 
     def _add_string_match_data(self, match) -> List[str]:
         """
@@ -303,41 +370,48 @@ class Yara(ServiceBase):
             match: Yara match object.
 
         Returns:
-            None.
+            List of string hit descriptions.
         """
-        string_hits = []
         strings = match.strings
+        if not strings:
+            return []
+
+        string_hits = []
+        # Only the hit count and the first 5 hits of each distinct string are kept: [count, [(offset, identifier)]]
         string_dict = {}
+        # Every hit is counted, memory stays bounded since only the first 5 hits of each distinct string are kept
         for offset, identifier, data in strings:
-            if data not in string_dict:
-                string_dict[data] = []
-            string_dict[data].append((offset, identifier))
+            entry = string_dict.get(data)
+            if entry is None:
+                string_dict[data] = [1, [(offset, identifier)]]
+                continue
+            entry[0] += 1
+            if len(entry[1]) < 5:
+                entry[1].append((offset, identifier))
 
         result_dict = {}
-        for string_value, string_list in string_dict.items():
+        for string_value, (count, string_list) in string_dict.items():
+            is_wide_char = self._is_wide_char(string_value)
+            if is_wide_char:
+                string_value = self._get_non_wide_char(string_value)
+            # Only the first 100 characters are displayed, truncate before escaping so large hits are not copied
+            truncated = len(string_value) > 100
+            string_value = string_value[:100]
             if isinstance(string_value, bytes):
                 string_value = safe_str(string_value)
-            count = len(string_list)
-            string_offset_list = []
-            ident = ''
-            for offset, ident in string_list[:5]:
-                string_offset_list.append(str(hex(offset)).replace("L", ""))
+            ident = string_list[-1][1]
 
             if ident == '$':
                 string_name = ""
             else:
                 string_name = f"{ident[1:]} "
 
-            string_offset = ", ".join(string_offset_list)
-            if len(string_list) > 5:
+            string_offset = ", ".join(f"{offset:#x}" for offset, _ in string_list)
+            if count > 5:
                 string_offset += "..."
 
-            is_wide_char = self._is_wide_char(string_value)
-            if is_wide_char:
-                string_value = self._get_non_wide_char(string_value)
-
             string_value = repr(string_value)
-            if len(string_value) > 100:
+            if truncated or len(string_value) > 100:
                 string_value = f"{string_value[:100]}..."
 
             wide_str = ""
@@ -368,23 +442,35 @@ class Yara(ServiceBase):
 
         return string_hits
 
-    def _extract_result_from_matches(self, matches):
+    def _extract_result_from_matches(self, matches, warnings=None):
         """
         Iterate through Yara match object and send to parser.
 
         Args:
             matches: Yara rules Match object (list).
+            warnings: Lines of the service warnings section, for conditions found while scanning.
 
         Returns:
             AL Result object.
         """
         result = Result()
-        for match in matches:
-            self._add_resultinfo_for_match(result, match)
+        for match in matches[:self.MAX_MATCHES]:
+            # Sections are added as they are built so each match's intermediate data can be released right away
+            result.add_section(self._build_section_for_match(match))
+        # result.order_results_by_score() TODO: should v4 support this?
+
+        warnings = list(warnings or [])
+        if len(matches) > self.MAX_MATCHES:
+            warnings.append(f"Too many rules matched ({len(matches)}). "
+                            f"Only the first {self.MAX_MATCHES} matches are reported.")
+        if warnings:
+            section = ResultSection("Service Warnings", parent=result)
+            for warning in warnings:
+                section.add_line(warning)
         return result
 
     @staticmethod
-    def _get_non_wide_char(string: str) -> str:
+    def _get_non_wide_char(string: bytes) -> bytes:
         """
         Convert wide string to regular string.
 
@@ -394,17 +480,12 @@ class Yara(ServiceBase):
         Returns:
             Converted string.
         """
-        res = []
-        for (i, c) in enumerate(string):
-            if i % 2 == 0:
-                res.append(str(c))
-
-        return ''.join(res)
+        return string[::2]
 
     @staticmethod
-    def _is_wide_char(string):
+    def _is_wide_char(string: bytes) -> bool:
         """
-        Determine if string is a wide-character string.
+        Determine if string is a wide-character string, i.e. every even byte is non-null and every odd byte is null.
 
         Args:
             string: Potential wide-character string.
@@ -412,22 +493,15 @@ class Yara(ServiceBase):
         Returns:
             True if wide character, or False.
         """
-        if len(string) >= 2 and len(string) % 2 == 0:
-            is_wide_char = True
-            for (i, c) in enumerate(string):
-                if ((i % 2 == 0 and c == 0) or
-                        (i % 2 == 1 and c != 0)):
-                    is_wide_char = False
-                    break
-        else:
-            is_wide_char = False
+        if not isinstance(string, bytes) or len(string) < 2 or len(string) % 2:
+            return False
 
-        return is_wide_char
+        return b'\x00' not in string[::2] and not string[1::2].strip(b'\x00')
 
     @staticmethod
     def _normalize_metadata(almeta):
         """Convert classification to uppercase."""
-        almeta.classification = almeta.classification.upper()
+        almeta.classification = _upper(almeta.classification)
 
     def _get_rules_hash(self):
         if not os.path.exists(FILE_UPDATE_DIRECTORY):
@@ -435,16 +509,16 @@ class Yara(ServiceBase):
             return None
 
         try:
-            rules_directory = max([os.path.join(FILE_UPDATE_DIRECTORY, d)
-                                   for d in os.listdir(FILE_UPDATE_DIRECTORY)
-                                   if os.path.isdir(os.path.join(FILE_UPDATE_DIRECTORY, d))
-                                   and not d.startswith('.tmp')],
-                                  key=os.path.getctime)
+            with os.scandir(FILE_UPDATE_DIRECTORY) as it:
+                rules_directory = max((e for e in it if e.is_dir() and not e.name.startswith('.tmp')),
+                                      key=lambda e: e.stat().st_ctime).path
         except ValueError:
             self.log.warning(f"No valid {self.name} rules directory found")
             return None
 
-        self.rules_list = [str(f) for f in Path(rules_directory).rglob("*") if os.path.isfile(str(f))]
+        self.rules_directory = rules_directory
+        self.rules_list = [e.path for e in _scan_files(rules_directory)
+                           if not e.name.endswith(COMPILED_RULES_EXTENSION)]
         all_sha256s = [get_sha256_for_file(f) for f in self.rules_list]
 
         self.log.info(f"{self.name} will load the following rule files: {self.rules_list}")
@@ -454,10 +528,59 @@ class Yara(ServiceBase):
 
         return hashlib.sha256(' '.join(sorted(all_sha256s)).encode('utf-8')).hexdigest()[:7]
 
+    def _rules_cache_path(self, yara_rules_dir: str) -> str:
+        """
+        Build the path of the compiled rules cache for the current set of rules files. The cache key covers the path,
+        modification time and size of every rules file, the externals, the YARA configuration and the YARA version so
+        that any change to the rules or to how they are compiled results in a new cache file.
+
+        Args:
+            yara_rules_dir: Directory containing the rules files.
+
+        Returns:
+            Path of the compiled rules cache file.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{yara.YARA_VERSION}:{','.join(sorted(self.yara_externals))}\n".encode('utf-8'))
+        # Limits such as max_strings_per_rule are enforced at compile time, so they are part of the compiled rules
+        digest.update(f"{sorted(self.yara_config.items())}\n".encode('utf-8'))
+        for rules_file in sorted(self.rules_list):
+            stat = os.stat(rules_file)
+            digest.update(f"{rules_file}:{stat.st_mtime_ns}:{stat.st_size}\n".encode('utf-8'))
+
+        return os.path.join(yara_rules_dir, f"compiled-{digest.hexdigest()}{COMPILED_RULES_EXTENSION}")
+
+    def _save_compiled_rules(self, rules, cache_path: str):
+        """
+        Save compiled rules to the cache file. The rules are written to a temporary file first and then renamed so that
+        a concurrent or interrupted start never sees a partially written cache.
+
+        Args:
+            rules: Compiled Yara rules object.
+            cache_path: Path of the compiled rules cache file.
+
+        Returns:
+            None.
+        """
+        temp_path = None
+        try:
+            # Service instances share the rules directory, the temporary file must be unique across all of them
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=COMPILED_RULES_EXTENSION)
+            with os.fdopen(fd, 'wb') as fh:
+                rules.save(file=fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(temp_path, cache_path)
+        except (OSError, yara.Error) as e:
+            self.log.warning(f"Could not save compiled {self.name} rules to cache: {str(e)}")
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
     def _load_rules(self):
         """
         Load Yara rules files. This function will check the updates directory and try to load the latest set of
-        Yara rules files. If not successful, it will try older versions of the Yara rules files.
+        Yara rules files. If not successful, it will try older versions of the Yara rules files. Compiled rules are
+        cached next to the rules files so that subsequent starts with the same rules skip the compilation step.
         """
         if not self.rules_list:
             raise Exception(f"No valid {self.name} rules files found")
@@ -467,7 +590,21 @@ class Yara(ServiceBase):
         if not yar_files:
             raise Exception(f"No valid {self.name} rules files found")
 
-        rules = yara.compile(filepaths=yar_files, externals=self.yara_externals)
+        cache_path = self._rules_cache_path(self.rules_directory)
+        rules = None
+        if os.path.exists(cache_path):
+            try:
+                rules = yara.load(cache_path)
+                self.log.info(f"{self.name} loaded compiled rules from cache: {cache_path}")
+            except yara.Error as e:
+                self.log.warning(f"Could not load compiled {self.name} rules from cache, recompiling: {str(e)}")
+
+        if rules is None:
+            # All namespaces are compiled into a single Rules object on purpose: yara-python cannot merge compiled
+            # Rules objects, and scanning with one object per namespace would re-read the file and re-run every
+            # module once per namespace on each request. The cache above keeps this cost to the first start only.
+            rules = yara.compile(filepaths=yar_files, externals=self.yara_externals)
+            self._save_compiled_rules(rules, cache_path)
 
         if rules:
             with self.initialization_lock:
@@ -478,65 +615,139 @@ class Yara(ServiceBase):
     # noinspection PyBroadException
     def execute(self, request):
         """Main Module. See README for details."""
-        if not self.rules:
+        # Rules.match is thread-safe and releases the GIL, so no lock is held while scanning. The initialization lock
+        # only protects swapping self.rules in _load_rules; the local reference keeps this scan on a single rule set.
+        rules = self.rules
+        if not rules:
             return
 
         request.set_service_context(f"{self.name} version: {self.get_tool_version()}")
 
-        self.deep_scan = request.task.deep_scan
+        # The task is kept in a context variable instead of on the instance so concurrent scans don't share it
+        token = _current_task.set(request.task)
+        try:
+            self._scan(request, rules)
+        finally:
+            _current_task.reset(token)
+
+    def _scan(self, request, rules):
+        """
+        Scan the request file with the given rules and set the request result.
+
+        Args:
+            request: AL service request object.
+            rules: Compiled Yara rules object.
+
+        Returns:
+            None.
+        """
         local_filename = request.file_path
-        tags = {f"al_{k.replace('.', '_')}": i for k, i in request.task.tags.items()}
+        yara_externals = self._get_yara_externals(request.task)
+
+        scan_timeout = self.config.get('scan_timeout', DEFAULT_SCAN_TIMEOUT)
+        fast_mode_threshold = self.config.get('fast_mode_threshold', DEFAULT_FAST_MODE_THRESHOLD)
+        start_time = time.monotonic()
+        with _map_file(local_filename) as file_data:
+            # Full mode scans of large files are too slow with large rule sets, scan those in fast mode right away
+            size_fast_mode = len(file_data) > fast_mode_threshold
+            fast_mode = size_fast_mode
+            try:
+                matches = rules.match(data=file_data, externals=yara_externals, fast=fast_mode, timeout=scan_timeout)
+            except yara.TimeoutError:
+                request.result = self._get_scan_not_completed_result(
+                    f"File could not be scanned within {scan_timeout} seconds.")
+                return
+            except yara.Error as e:
+                # Internal error 30 == exceeded max string matches on rule
+                if "internal error: 30" not in str(e):
+                    raise
+                matches = None
+
+            if matches is None and not fast_mode:
+                # The scan timeout covers both passes, the retry only gets what is left of it
+                remaining_timeout = int(scan_timeout - (time.monotonic() - start_time))
+                if remaining_timeout < 1:
+                    request.result = self._get_scan_not_completed_result(
+                        f"File could not be scanned within {scan_timeout} seconds.")
+                    return
+                try:
+                    # Fast mode == Yara skips strings already found
+                    matches = rules.match(data=file_data, externals=yara_externals, fast=True,
+                                          timeout=remaining_timeout)
+                    fast_mode = True
+                except yara.TimeoutError:
+                    request.result = self._get_scan_not_completed_result(
+                        f"File could not be scanned within {scan_timeout} seconds.")
+                    return
+                except yara.Error as e:
+                    if "internal error: 30" not in str(e):
+                        raise
+
+            if matches is None:
+                self.log.warning(f"YARA internal error 30 detected on submission {request.task.sid}")
+                request.result = self._get_scan_not_completed_result(
+                    "File returned too many matches with current rule set and YARA exited.")
+                return
 
-        yara_externals = {}
-        for k in self.yara_externals.keys():
-            # Check default request.task fields
-            sval = request.task.__dict__.get(k, None)
+        warnings = []
+        if size_fast_mode:
+            warnings.append(f"File is larger than {fast_mode_threshold} bytes. "
+                            f"{self.name} forced to scan in fast mode.")
+        elif fast_mode:
+            warnings.append("Too many matches detected with current ruleset. "
+                            f"{self.name} forced to scan in fast mode.")
+        request.result = self._extract_result_from_matches(matches, warnings=warnings)
 
-            # if not sval:
-            #     # Check metadata dictionary
-            #     sval = request.task.metadata.get(k, None)
+    def _get_yara_externals(self, task) -> Dict[str, str]:
+        """
+        Resolve the value of each Yara external from the task fields, the service parameters, the tags and the
+        temporary submission data, in that order.
 
-            if not sval:
-                # Check params dictionary
-                sval = request.task.service_config.get(k, None)
+        Args:
+            task: AL task object.
 
-            if not sval:
-                # Check tags list
-                val_list = tags.get(k, None)
-                if val_list:
-                    sval = " | ".join(val_list)
+        Returns:
+            Externals values to be used for the scan.
+        """
+        task_fields = task.__dict__
+        service_config = task.service_config or {}
+        temp_submission_data = task.temp_submission_data or {}
+        tags = None
+        _safe_str = safe_str
+
+        yara_externals = {}
+        for k in self.yara_externals:
+            # Check default request.task fields, then the params dictionary, task metadata is intentionally not used
+            sval = task_fields.get(k, None) or service_config.get(k, None)
 
             if not sval:
-                # Check temp submission data
-                sval = request.task.temp_submission_data.get(k, None)
+                # Check tags list, only converting tag names to externals names when a tag is needed,
+                # then the temp submission data
+                if tags is None:
+                    tags = {f"al_{t.replace('.', '_')}": v for t, v in task.tags.items()}
+                val_list = tags.get(k, None)
+                sval = " | ".join(val_list) if val_list else temp_submission_data.get(k, None)
 
             # Normalize unicode with safe_str and make sure everything else is a string
             if sval:
-                yara_externals[k] = safe_str(sval)
+                yara_externals[k] = _safe_str(sval)
 
-        with self.initialization_lock:
-            try:
-                matches = self.rules.match(local_filename, externals=yara_externals)
-                request.result = self._extract_result_from_matches(matches)
-            except Exception as e:
-                # Internal error 30 == exceeded max string matches on rule
-                if e != "internal error: 30":
-                    raise
-                else:
-                    try:
-                        # Fast mode == Yara skips strings already found
-                        matches = self.rules.match(local_filename, externals=yara_externals, fast=True)
-                        result = self._extract_result_from_matches(matches)
-                        section = ResultSection("Service Warnings", parent=result)
-                        section.add_line("Too many matches detected with current ruleset. "
-                                         f"{self.name} forced to scan in fast mode.")
-                        request.result = result
-                    except Exception:
-                        self.log.warning(f"YARA internal error 30 detected on submission {request.task.sid}")
-                        result = Result()
-                        section = ResultSection(f"{self.name} scan not completed.", parent=result)
-                        section.add_line("File returned too many matches with current rule set and YARA exited.")
-                        request.result = result
+        return yara_externals
+
+    def _get_scan_not_completed_result(self, message: str) -> Result:
+        """
+        Build the result reported when YARA could not complete the scan of a file.
+
+        Args:
+            message: Reason why the scan was not completed.
+
+        Returns:
+            AL Result object.
+        """
+        result = Result()
+        section = ResultSection(f"{self.name} scan not completed.", parent=result)
+        section.add_line(message)
+        return result
 
     def get_tool_version(self):
         """
@@ -553,8 +764,17 @@ class Yara(ServiceBase):
             return basic_version
 
     def start(self):
-        # Set configuration flags to 4 times the default
-        yara.set_config(max_strings_per_rule=40000, stack_size=65536)
+        # Set configuration flags, these must be set before the rules are compiled
+        yara_config = dict(
+            max_strings_per_rule=self.config.get('max_strings_per_rule', DEFAULT_MAX_STRINGS_PER_RULE),
+            stack_size=self.config.get('stack_size', DEFAULT_STACK_SIZE),
+        )
+        max_match_data = self.config.get('max_match_data', None)
+        if max_match_data:
+            # Only supported by YARA 4 and up
+            yara_config['max_match_data'] = max_match_data
+        yara.set_config(**yara_config)
+        self.yara_config = yara_config
 
         try:
             # Load the rules
@@ -1,12 +1,15 @@
 import glob
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
 import tempfile
-import time
-from typing import List, Dict, Any, Optional, Set
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Dict, Any, Optional, Set, Tuple
 from zipfile import ZipFile
 
 import requests
@@ -14,11 +17,10 @@ import yaml
 from assemblyline.common import forge
 from assemblyline.common.isotime import iso_to_epoch
 from assemblyline_client import get_client
-from git import Repo
+from git import Git, Repo
 from plyara import Plyara, utils
 
 from assemblyline.common import log as al_log
-from assemblyline.common.digests import get_sha256_for_file
 from yara_.yara_importer import YaraImporter
 from yara_.yara_validator import YaraValidator
 
@@ -29,6 +31,16 @@ UPDATE_OUTPUT_PATH = os.environ.get('UPDATE_OUTPUT_PATH', "/tmp/yara_updater_out
 UPDATE_DIR = os.path.join(tempfile.gettempdir(), 'yara_updates')
 
 YARA_EXTERNALS = {f'al_{x}': x for x in ['submitter', 'mime', 'tag']}
+# Number of sources downloaded at the same time
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of sources parsed at the same time, each parser holds a whole source and its parse tree in memory
+PARSE_WORKERS = 4
+
+# Include statement at the start of a line, capturing the included path, up to the end of its line
+INCLUDE_RE = re.compile(r'^include[ \t]+["\'](.+?)["\'][^\n]*\n?', re.MULTILINE)
+# Only the latest commit of the default branch is needed to read the rules
+GIT_CLONE_OPTIONS = ['--depth=1', '--single-branch']
 
 
 def _compile_rules(rules_file, externals, cur_logger):
@@ -67,7 +79,8 @@ def guess_category(rule_file_name):
     return None
 
 
-def url_download(download_directory: str, source: Dict[str, Any], cur_logger, previous_update=None) -> Optional[str]:
+def url_download(download_directory: str, source: Dict[str, Any], cur_logger, previous_update=None,
+                 previous_etag=None) -> Tuple[Optional[str], Optional[str]]:
     if os.path.exists(download_directory):
         shutil.rmtree(download_directory)
     os.makedirs(download_directory)
@@ -78,7 +91,8 @@ def url_download(download_directory: str, source: Dict[str, Any], cur_logger, pr
     password = source.get('password', None)
     auth = (username, password) if username and password else None
 
-    headers = source.get('headers', None)
+    # Copy the headers so the conditional request headers do not leak into the source configuration
+    headers = dict(source.get('headers', None) or {})
 
     # Create a requests session
     session = requests.Session()
@@ -92,36 +106,38 @@ def url_download(download_directory: str, source: Dict[str, Any], cur_logger, pr
         last_modified = response.headers.get('Last-Modified', None)
         if last_modified:
             # Convert the last modified time to epoch
-            last_modified = time.mktime(time.strptime(last_modified, "%a, %d %b %Y %H:%M:%S %Z"))
+            last_modified = parsedate_to_datetime(last_modified).timestamp()
 
             # Compare the last modified time with the last updated time
             if previous_update and last_modified <= previous_update:
                 # File has not been modified since last update, do nothing
                 cur_logger.info("The file has not been modified since last run, skipping...")
-                return
+                return None, previous_etag
 
         if previous_update:
-            previous_update = time.strftime("%a, %d %b %Y %H:%M:%S %Z", time.gmtime(previous_update))
-            if headers:
-                headers['If-Modified-Since'] = previous_update
-            else:
-                headers = {'If-Modified-Since': previous_update}
-
-        response = session.get(uri, auth=auth, headers=headers)
-
-        # Check the response code
-        if response.status_code == requests.codes['not_modified']:
-            # File has not been modified since last update, do nothing
-            cur_logger.info("The file has not been modified since last run, skipping...")
-            return
-        elif response.ok:
-            file_name = os.path.basename(f"{name}.yar")  # TODO: make filename as source name with extension .yar
-            file_path = os.path.join(download_directory, file_name)
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-
-            # Return file_path
-            return file_path
+            previous_update = formatdate(previous_update, usegmt=True)
+            headers['If-Modified-Since'] = previous_update
+
+        # Servers that do not provide a useful Last-Modified date usually provide an ETag instead
+        if previous_etag:
+            headers['If-None-Match'] = previous_etag
+
+        # Stream the response to disk instead of holding the whole file in memory
+        with session.get(uri, auth=auth, headers=headers, stream=True) as response:
+            # Check the response code
+            if response.status_code == requests.codes['not_modified']:
+                # File has not been modified since last update, do nothing
+                cur_logger.info("The file has not been modified since last run, skipping...")
+                return None, previous_etag
+            elif response.ok:
+                file_name = os.path.basename(f"{name}.yar")  # TODO: make filename as source name with extension .yar
+                file_path = os.path.join(download_directory, file_name)
+                with open(file_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
+                # Return file_path and the ETag to send back on the next run
+                return file_path, response.headers.get('ETag', None)
     except requests.Timeout:
         # TODO: should we retry?
         pass
@@ -134,9 +150,11 @@ def url_download(download_directory: str, source: Dict[str, Any], cur_logger, pr
         # Close the requests session
         session.close()
 
+    return None, None
+
 
 def git_clone_repo(download_directory: str, source: Dict[str, Any], cur_logger,
-                   previous_update=None) -> List[str] and List[str]:
+                   previous_update=None, previous_head=None) -> Tuple[List[str], Optional[str]]:
     name = source['name']
     url = source['uri']
     pattern = source.get('pattern', None)
@@ -147,10 +165,12 @@ def git_clone_repo(download_directory: str, source: Dict[str, Any], cur_logger,
         shutil.rmtree(clone_dir)
     os.makedirs(clone_dir)
 
+    env = None
     if key:
         cur_logger.info(f"key found for {url}")
         # Save the key to a file
-        git_ssh_identity_file = os.path.join(tempfile.gettempdir(), 'id_rsa')
+        # Sources are cloned in parallel, each of them needs its own key file
+        git_ssh_identity_file = os.path.join(tempfile.gettempdir(), f'id_rsa_{name}')
         if os.path.exists(git_ssh_identity_file):
             os.unlink(git_ssh_identity_file)
         with open(git_ssh_identity_file, 'w') as key_fh:
@@ -158,9 +178,18 @@ def git_clone_repo(download_directory: str, source: Dict[str, Any], cur_logger,
         os.chmod(git_ssh_identity_file, 0o0400)
 
         git_ssh_cmd = f"ssh -oStrictHostKeyChecking=no -i {git_ssh_identity_file}"
-        repo = Repo.clone_from(url, clone_dir, env={"GIT_SSH_COMMAND": git_ssh_cmd})
-    else:
-        repo = Repo.clone_from(url, clone_dir)
+        env = {"GIT_SSH_COMMAND": git_ssh_cmd}
+
+    # Check the remote HEAD before cloning, nothing needs to be transferred if it has not moved since last run
+    # Some remotes do not advertise HEAD, those are always cloned
+    remote_head = next(iter(Git().ls_remote(url, 'HEAD', env=env).split()), None)
+    if previous_head and remote_head == previous_head:
+        cur_logger.info("The repository HEAD has not changed since last run, skipping repository...")
+        return [], remote_head
+
+    repo = Repo.clone_from(url, clone_dir, env=env, multi_options=GIT_CLONE_OPTIONS)
+    if not remote_head:
+        remote_head = repo.head.commit.hexsha
 
     # Check repo last commit
     if previous_update:
@@ -169,7 +198,7 @@ def git_clone_repo(download_directory: str, source: Dict[str, Any], cur_logger,
         for c in repo.iter_commits():
             if c.committed_date < previous_update:
                 cur_logger.info("There are no new commits, skipping repository...")
-                return []
+                return [], remote_head
             break
 
     if pattern:
@@ -182,31 +211,144 @@ def git_clone_repo(download_directory: str, source: Dict[str, Any], cur_logger,
     if not files:
         cur_logger.warning(f"Could not find any yara file matching pattern: {pattern or '*.yar*'}")
 
-    return files
+    return files, remote_head
+
 
+def fetch_source(download_directory: str, source: Dict[str, Any], cur_logger, previous_update=None,
+                 previous_head=None, previous_etag=None) -> Tuple[List[str], Optional[str], Optional[str]]:
+    """
+    Download the files of a single source, either by cloning its git repository or by downloading its URL.
+
+    Args:
+        download_directory: Directory where the source files are downloaded, each source gets its own subdirectory.
+        source: Source configuration.
+        cur_logger: Logger.
+        previous_update: Time of the previous update.
+        previous_head: Remote HEAD of the source git repository at the previous update.
+        previous_etag: ETag of the source URL at the previous update.
 
-def replace_include(include, dirname, processed_files: Set[str], cur_logger):
-    include_path = re.match(r"include [\'\"](.{4,})[\'\"]", include).group(1)
+    Returns:
+        Paths of the downloaded files, empty if the source has not changed since the previous update, the remote
+        HEAD for git sources and the ETag for URL sources.
+    """
+    cur_logger.info(f"Downloading files from: {source['uri']}")
+    uri: str = source['uri']
+
+    if uri.endswith('.git'):
+        files, remote_head = git_clone_repo(download_directory, source, cur_logger, previous_update=previous_update,
+                                            previous_head=previous_head)
+        return files, remote_head, None
+
+    file_path, etag = url_download(os.path.join(download_directory, source['name']), source, cur_logger,
+                                   previous_update=previous_update, previous_etag=previous_etag)
+    return ([file_path] if file_path else []), None, etag
+
+
+def replace_include(include_path: str, dirname: str, processed_files: Set[str], cur_logger) -> List[str]:
+    """
+    Get the content of an included file, with its own includes expanded.
+
+    Args:
+        include_path: Path of the included file, as written in the include statement.
+        dirname: Directory of the file containing the include statement.
+        processed_files: Files already included, those are not included again.
+        cur_logger: Logger.
+
+    Returns:
+        Parts of the expanded content.
+    """
     full_include_path = os.path.normpath(os.path.join(dirname, include_path))
     if not os.path.exists(full_include_path):
         cur_logger.info(f"File doesn't exist: {full_include_path}")
-        return [], processed_files
+        return []
 
-    temp_lines = ['\n']  # Start with a new line to separate rules
+    parts = ['\n']  # Start with a new line to separate rules
     if full_include_path not in processed_files:
         processed_files.add(full_include_path)
+        # Included files are not cached, processed_files already stops a file from being read twice in a source and
+        # each source is downloaded to its own directory, so include paths are never shared between sources
         with open(full_include_path, 'r') as include_f:
-            lines = include_f.readlines()
+            content = include_f.read()
+
+        parts.extend(expand_includes(content, os.path.dirname(full_include_path), processed_files, cur_logger))
+
+    return parts
+
+
+def expand_includes(content: str, dirname: str, processed_files: Set[str], cur_logger) -> List[str]:
+    """
+    Replace the include statements of Yara rules content with the content of the included files.
+
+    Args:
+        content: Yara rules content.
+        dirname: Directory of the file the content comes from, include paths are relative to it.
+        processed_files: Files already included, those are not included again.
+        cur_logger: Logger.
+
+    Returns:
+        Parts of the expanded content.
+    """
+    # Most rule files have no include statement at all, skip the regex scan for them
+    first_include = content.find('include')
+    if first_include == -1:
+        return [content]
+
+    parts = []
+    prev_end = 0
+    # Start the regex scan at the line of the first occurrence found by the C level search
+    for match in INCLUDE_RE.finditer(content, content.rfind('\n', 0, first_include) + 1):
+        parts.append(content[prev_end:match.start()])
+        parts.extend(replace_include(match.group(1), dirname, processed_files, cur_logger))
+        prev_end = match.end()
+    parts.append(content[prev_end:])
+
+    return parts
+
+
+def _parse_and_rebuild(source_content: str, file_start_lines: List[int], file_categories: List[str]) -> bytes:
+    """
+    Parse the aggregated rules of a source, add the guessed categories and rebuild the rules.
+
+    Runs in a separate process, Plyara parsing is CPU bound and would be serialized by the GIL in threads.
+
+    Args:
+        source_content: Aggregated content of the source files.
+        file_start_lines: Line of the aggregated content where each file starts.
+        file_categories: Category guessed from the name of each file.
+
+    Returns:
+        Rebuilt rules of the source.
+    """
+    # Parse all the files of the source at once
+    # Plyara is kept over yara-x, whose Python bindings only compile rules and do not expose them for rebuilding
+    signatures = Plyara().parse_string(source_content)
+
+    # Guess category
+    for s in signatures:
+        file_index = bisect_right(file_start_lines, s.get('start_line', 1)) - 1
+        guessed_category = file_categories[max(file_index, 0)]
+        if not guessed_category:
+            continue
+
+        if 'metadata' not in s:
+            s['metadata'] = []
+
+        # Do not override category with guessed category if it already exists
+        for meta in s['metadata']:
+            if 'category' in meta:
+                continue
+
+        s['metadata'].append({'category': guessed_category})
+        s['metadata'].append({guessed_category: s.get('rule_name')})
 
-        for i, line in enumerate(lines):
-            if line.startswith("include"):
-                new_dirname = os.path.dirname(full_include_path)
-                lines, processed_files = replace_include(line, new_dirname, processed_files, cur_logger)
-                temp_lines.extend(lines)
-            else:
-                temp_lines.append(line)
+    rule_bufs = []
+    for s in signatures:
+        # Fix imports and remove cuckoo
+        s['imports'] = utils.detect_imports(s)
+        if "cuckoo" not in s['imports']:
+            rule_bufs.append(utils.rebuild_yara_rule(s))
 
-    return temp_lines, processed_files
+    return "".join(rule_bufs).encode('utf-8')
 
 
 def yara_update(updater_type, update_config_path, update_output_path,
@@ -241,8 +383,18 @@ def yara_update(updater_type, update_config_path, update_output_path,
         # Parse updater configuration
         previous_update = update_config.get('previous_update', None)
         previous_hash = json.loads(update_config.get('previous_hash', None) or "{}")
+        # Only the hash is passed back to the next run, it also carries the state of the sources
+        previous_heads = previous_hash.pop('heads', {})
+        previous_raw_hashes = previous_hash.pop('raw_hashes', {})
+        previous_etags = previous_hash.pop('etags', {})
+        previous_file_hashes = previous_hash.pop('file_hashes', {})
         sources = {source['name']: source for source in update_config['sources']}
         files_sha256 = {}
+        source_heads = {}
+        source_raw_hashes = {}
+        source_etags = {}
+        # Content hashes of the files kept by each source
+        source_file_hashes = {}
         files_default_classification = {}
 
         # Create working directory
@@ -251,87 +403,118 @@ def yara_update(updater_type, update_config_path, update_output_path,
             shutil.rmtree(updater_working_dir)
         os.makedirs(updater_working_dir)
 
-        # Go through each source and download file
-        for source_name, source in sources.items():
-            os.makedirs(os.path.join(updater_working_dir, source_name))
-            # 1. Download signatures
-            cur_logger.info(f"Downloading files from: {source['uri']}")
-            uri: str = source['uri']
-
-            if uri.endswith('.git'):
-                files = git_clone_repo(download_directory, source, cur_logger, previous_update=previous_update)
-            else:
-                files = [url_download(download_directory, source, cur_logger, previous_update=previous_update)]
-
-            processed_files = set()
-
-            # 2. Aggregate files
-            file_name = os.path.join(updater_working_dir, f"{source_name}.yar")
-            mode = "w"
-            for file in files:
-                # File has already been processed before, skip it to avoid duplication of rules
-                if file in processed_files:
-                    continue
-
-                cur_logger.info(f"Processing file: {file}")
-
-                file_dirname = os.path.dirname(file)
-                processed_files.add(os.path.normpath(file))
-                with open(file, 'r') as f:
-                    f_lines = f.readlines()
-
-                temp_lines = []
-                for i, f_line in enumerate(f_lines):
-                    if f_line.startswith("include"):
-                        lines, processed_files = replace_include(f_line, file_dirname, processed_files, cur_logger)
-                        temp_lines.extend(lines)
+        # Source of the first file found with each content hash
+        seen_hashes = {}
+
+        # Go through each source and download file, downloads are network bound so all sources are fetched in
+        # parallel, they are processed in configuration order so the same source keeps duplicated files on every run
+        parse_tasks = {}
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = {source_name: executor.submit(fetch_source, download_directory, source, cur_logger,
+                                                    previous_update=previous_update,
+                                                    previous_head=previous_heads.get(source_name, None),
+                                                    previous_etag=previous_etags.get(source_name, None))
+                       for source_name, source in sources.items()}
+            for source_name, future in futures.items():
+                os.makedirs(os.path.join(updater_working_dir, source_name))
+                # 1. Download signatures
+                files, remote_head, etag = future.result()
+                if remote_head:
+                    source_heads[source_name] = remote_head
+                if not files:
+                    # Sources skipped before download keep their state, so their next download can still be compared
+                    etag = etag or previous_etags.get(source_name, None)
+                    if source_name in previous_raw_hashes:
+                        source_raw_hashes[source_name] = previous_raw_hashes[source_name]
+                    # Their rules are still imported, they keep the files they had so no other source takes them over
+                    for content_sha256 in previous_file_hashes.get(source_name, []):
+                        if content_sha256 not in seen_hashes:
+                            seen_hashes[content_sha256] = source_name
+                            source_file_hashes.setdefault(source_name, []).append(content_sha256)
+                if etag:
+                    source_etags[source_name] = etag
+
+                processed_files = set()
+
+                # 2. Aggregate files
+                source_parts = []
+                # Line of the aggregated content where each file starts and the category guessed from its name
+                file_start_lines = []
+                file_categories = []
+                line_count = 1
+                for file in files:
+                    # File has already been processed before, skip it to avoid duplication of rules
+                    if file in processed_files:
+                        continue
+
+                    cur_logger.info(f"Processing file: {file}")
+
+                    file_dirname = os.path.dirname(file)
+                    processed_files.add(os.path.normpath(file))
+                    with open(file, 'r') as f:
+                        content = f.read()
+
+                    content = "".join(expand_includes(content, file_dirname, processed_files, cur_logger))
+                    if not content.endswith('\n'):
+                        content += '\n'
+
+                    # Sources often mirror the same upstream rule files, only process the first copy
+                    # The content is hashed once its includes are expanded, the same include statements can refer to
+                    # different rules in different sources
+                    content_sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
+                    if content_sha256 in seen_hashes:
+                        cur_logger.info(f"File {file} has the same content as a file of source "
+                                        f"{seen_hashes[content_sha256]}, skipping it...")
+                        continue
+                    seen_hashes[content_sha256] = source_name
+                    source_file_hashes.setdefault(source_name, []).append(content_sha256)
+
+                    # guess the type of files that we have in the current file
+                    file_start_lines.append(line_count)
+                    file_categories.append(guess_category(file))
+                    line_count += content.count('\n')
+                    source_parts.append(content)
+
+                source_content = "".join(source_parts)
+                if source_content:
+                    # Parsing is the most expensive step, skip it if the source content has not changed since the
+                    # last run
+                    # The guessed categories are part of the output, so they are part of the hash as well
+                    raw_sha256 = hashlib.sha256(
+                        f"{file_start_lines}{file_categories}\n{source_content}".encode('utf-8')).hexdigest()
+                    source_raw_hashes[source_name] = raw_sha256
+                    if raw_sha256 == previous_raw_hashes.get(source_name, None):
+                        cur_logger.info(f'Source {source_name} has not changed since last run. Skipping it...')
+                        source_content = None
+
+                if source_content:
+                    parse_tasks[source_name] = (source_content, file_start_lines, file_categories)
+
+        # 3. Parse and rebuild the rules, parsing is CPU bound so it is done in separate processes
+        # The pool is only started once the download threads are done, so no process is forked while they run
+        if parse_tasks:
+            with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(parse_tasks))) as parser:
+                parse_futures = {source_name: parser.submit(_parse_and_rebuild, *task)
+                                 for source_name, task in parse_tasks.items()}
+                for source_name, future in parse_futures.items():
+                    source = sources[source_name]
+                    file_name = os.path.join(updater_working_dir, f"{source_name}.yar")
+
+                    # Save all rules from source into single file
+                    rules_data = future.result()
+                    # Hash the rules as they are written instead of reading the file back
+                    sha256 = hashlib.sha256(rules_data).hexdigest()
+                    with open(file_name, 'wb') as f:
+                        f.write(rules_data)
+
+                    # Check if the file is the same as the last run
+                    cache_name = os.path.basename(file_name)
+                    if sha256 != previous_hash.get(cache_name, None):
+                        files_sha256[cache_name] = sha256
+                        files_default_classification[cache_name] = source.get('default_classification',
+                                                                              classification.UNRESTRICTED)
                     else:
-                        temp_lines.append(f_line)
-
-                # guess the type of files that we have in the current file
-                guessed_category = guess_category(file)
-                parser = Plyara()
-                signatures = parser.parse_string("\n".join(temp_lines))
-
-                # Ignore "cuckoo" rules
-                if "cuckoo" in parser.imports:
-                    parser.imports.remove("cuckoo")
-
-                # Guess category
-                if guessed_category:
-                    for s in signatures:
-                        if 'metadata' not in s:
-                            s['metadata'] = []
-
-                        # Do not override category with guessed category if it already exists
-                        for meta in s['metadata']:
-                            if 'category' in meta:
-                                continue
-
-                        s['metadata'].append({'category': guessed_category})
-                        s['metadata'].append({guessed_category: s.get('rule_name')})
-
-                # Save all rules from source into single file
-                with open(file_name, mode) as f:
-                    for s in signatures:
-                        # Fix imports and remove cuckoo
-                        s['imports'] = utils.detect_imports(s)
-                        if "cuckoo" not in s['imports']:
-                            f.write(utils.rebuild_yara_rule(s))
-
-                if mode == "w":
-                    mode = "a"
-
-            # Check if the file is the same as the last run
-            if os.path.exists(file_name):
-                cache_name = os.path.basename(file_name)
-                sha256 = get_sha256_for_file(file_name)
-                if sha256 != previous_hash.get(cache_name, None):
-                    files_sha256[cache_name] = sha256
-                    files_default_classification[cache_name] = source.get('default_classification',
-                                                                          classification.UNRESTRICTED)
-                else:
-                    cur_logger.info(f'File {cache_name} has not changed since last run. Skipping it...')
+                        cur_logger.info(f'File {cache_name} has not changed since last run. Skipping it...')
 
         if files_sha256:
             cur_logger.info(f"Found new {updater_type.upper()} rules files to process!")
@@ -346,6 +529,8 @@ def yara_update(updater_type, update_config_path, update_output_path,
                 default_classification = files_default_classification.get(base_file, classification.UNRESTRICTED)
 
                 try:
+                    # Validated files are not cached, the updater starts from an empty directory on every run and only
+                    # the files which changed since the previous run are validated, each of them once
                     _compile_rules(cur_file, externals, cur_logger)
                     yara_importer.import_file(cur_file, source_name, default_classification=default_classification)
                 except Exception as e:
@@ -372,7 +557,10 @@ def yara_update(updater_type, update_config_path, update_output_path,
 
             # Create the response yaml
             with open(os.path.join(update_output_path, 'response.yaml'), 'w') as yml_fh:
-                yaml.safe_dump(dict(hash=json.dumps(files_sha256)), yml_fh)
+                yaml.safe_dump(dict(hash=json.dumps(dict(files_sha256, heads=source_heads,
+                                                         raw_hashes=source_raw_hashes, etags=source_etags,
+                                                         file_hashes=source_file_hashes))),
+                               yml_fh)
 
             cur_logger.info(f"New ruleset successfully downloaded and ready to use")
 
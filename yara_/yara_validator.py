@@ -1,14 +1,13 @@
-import json
 import logging
-import os
 import re
-import subprocess
-import tempfile
 
-from assemblyline.common.str_utils import safe_str
+import yara
+from plyara import Plyara, utils
 
 
 class YaraValidator(object):
+    # Number of errors cleaned one at a time before compiling the rules one by one to find the remaining ones
+    MAX_LINE_CLEAN_RETRIES = 10
 
     def __init__(self, externals=None, logger=None):
         if not logger:
@@ -22,10 +21,9 @@ class YaraValidator(object):
         self.externals = externals
         self.rulestart = re.compile(r'^(?:global )?(?:private )?(?:private )?rule ', re.MULTILINE)
         self.rulename = re.compile('rule ([^{^:]+)')
+        self.syntax_error = re.compile(r'^yara\.SyntaxError\.line (\d+): (.*)$', re.DOTALL)
 
-    def clean(self, rulefile, eline, message, invalid_rule_name):
-        with open(rulefile, 'r') as f:
-            f_lines = f.readlines()
+    def clean(self, f_lines, eline, message, invalid_rule_name):
         # List will start at 0 not 1
         error_line = eline - 1
 
@@ -46,19 +44,20 @@ class YaraValidator(object):
                     invalid_rule_name = re.search(self.rulename, line).group(1).strip()
 
                     # Second loop to find end of rule
-                    end_idx = 0
+                    # The rule ends at the next rule start, searched after the error line and the current rule start
+                    end_idx = max(error_line, find_start + 1)
                     while True:
-                        find_end = error_line + end_idx
+                        find_end = end_idx
                         if find_end >= len(f_lines):
                             raise Exception("Yara Validator failed to find invalid rule end. "
                                             f"Yara Error: {message} Line: {eline}")
                         line = f_lines[find_end]
                         if re.match(self.rulestart, line) or find_end == len(f_lines) - 1:
                             # Now we have the start and end, strip from file
-                            if find_end == len(f_lines) - 1:
-                                f_lines = f_lines[:find_start]
-                            else:
+                            if re.match(self.rulestart, line):
                                 f_lines = f_lines[:find_start] + f_lines[find_end:]
+                            else:
+                                f_lines = f_lines[:find_start]
                             break
                         end_idx += 1
                     # Send the error output to AL logs
@@ -68,57 +67,98 @@ class YaraValidator(object):
                     break
                 start_idx += 1
 
-        with open(rulefile, 'w') as f:
-            f.writelines(f_lines)
-
-        return invalid_rule_name
+        return f_lines, invalid_rule_name
 
-    def paranoid_rule_check(self, rulefile):
-        # Run rules separately on command line to ensure there are no errors
-        print_val = "--==Rules_validated++__"
-        external_file = os.path.join(tempfile.gettempdir(), "externals.json")
+    def paranoid_rule_check(self, rules_source):
+        # Compile and run the rules to ensure there are no errors
         try:
-            with open(external_file, "wb") as out_json:
-                out_json.write(json.dumps(self.externals).encode("utf-8"))
-
-            p = subprocess.Popen(f"python3 paranoid_check.py {rulefile} {external_file}",
-                                 cwd=os.path.dirname(os.path.realpath(__file__)),
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            stdout, stderr = p.communicate()
-
-        finally:
-            os.unlink(external_file)
+            yara.compile(source=rules_source, externals=self.externals).match(data='')
+        except yara.SyntaxError as e:
+            raise Exception(f"yara.SyntaxError.{str(e)}")
+        except yara.Error as e:
+            raise Exception(f"YaraValidator has failed!--+--{str(e)}")
+
+    def remove_invalid_rules(self, f_lines):
+        # Compile each rule on its own, along with the rules it depends on, to find all the invalid rules in one pass
+        try:
+            rules = Plyara().parse_string(''.join(f_lines))
+        except Exception as e:
+            self.log.info(f"Yara rules could not be parsed, invalid rules will be removed one at a time [{e}]")
+            return f_lines, False
+
+        # Duplicated rule names are left to the line based cleaning, dependencies refer to the first definition
+        rules_by_name = {}
+        for rule in rules:
+            rules_by_name.setdefault(rule['rule_name'], rule)
+        invalid_rules = []
+        for rule in rules:
+            # Gather the rules this rule depends on, they have to be compiled with it
+            required = {rule['rule_name']: rule}
+            pending = [rule]
+            while pending:
+                for dependency in utils.detect_dependencies(pending.pop()):
+                    if dependency in rules_by_name and dependency not in required:
+                        required[dependency] = rules_by_name[dependency]
+                        pending.append(rules_by_name[dependency])
+            required_rules = sorted(required.values(), key=lambda r: r['start_line'])
+
+            imports = {module for r in required_rules for module in utils.detect_imports(r)}
+            rule_source = ''.join(f'import "{module}"\n' for module in sorted(imports))
+            rule_source += ''.join(''.join(f_lines[r['start_line'] - 1:r['stop_line']]) for r in required_rules)
+            try:
+                self.paranoid_rule_check(rule_source)
+            except Exception as e:
+                syntax_error = self.syntax_error.match(str(e))
+                # Errors which are not specific to this rule are left to the line based cleaning, as are undefined
+                # identifiers which may be rules referenced in a way the dependency detection does not catch
+                if syntax_error and "undefined identifier" not in syntax_error.group(2):
+                    invalid_rules.append(rule)
+                    self.log.warning(f"Yara rule '{rule['rule_name']}' removed from rules file because of an "
+                                     f"error at line {rule['start_line']} [{syntax_error.group(2)}].")
 
-        stdout = safe_str(stdout)
-        stderr = safe_str(stderr)
+        # Strip all the invalid rules at once, starting from the end so the line numbers stay valid
+        for rule in sorted(invalid_rules, key=lambda r: r['start_line'], reverse=True):
+            f_lines = f_lines[:rule['start_line'] - 1] + f_lines[rule['stop_line']:]
 
-        if print_val not in stdout:
-            if stdout.strip().startswith('yara.SyntaxError'):
-                raise Exception(stdout.strip())
-            else:
-                raise Exception("YaraValidator has failed!--+--" + str(stderr) + "--:--" + str(stdout))
+        return f_lines, bool(invalid_rules)
 
     def validate_rules(self, rulefile):
+        # The rules are kept in memory while they are cleaned and only written back once they are valid
+        with open(rulefile, 'r') as f:
+            f_lines = f.readlines()
+
         change = False
+        line_clean_retries = 0
+        per_rule_checked = False
         while True:
             try:
-                self.paranoid_rule_check(rulefile)
-                return change
+                self.paranoid_rule_check(''.join(f_lines))
+                break
 
             # If something goes wrong, clean rules until valid file given
             except Exception as e:
                 error = str(e)
                 change = True
-                if error.startswith('yara.SyntaxError'):
-
-                    e_line = int(error.split('):', 1)[0].split("(", -1)[1])
-                    e_message = error.split("): ", 1)[1]
+                syntax_error = self.syntax_error.match(error)
+                # Cleaning one error per compile is cheap for a few invalid rules, the rules are only compiled one by
+                # one when there are many of them. Duplicated rule names cannot be found that way.
+                if syntax_error and not per_rule_checked and line_clean_retries >= self.MAX_LINE_CLEAN_RETRIES \
+                        and "duplicated identifier" not in error:
+                    per_rule_checked = True
+                    f_lines, removed = self.remove_invalid_rules(f_lines)
+                    if removed:
+                        continue
+
+                if syntax_error:
+                    line_clean_retries += 1
+                    e_line = int(syntax_error.group(1))
+                    e_message = syntax_error.group(2)
                     if "duplicated identifier" in error:
                         invalid_rule_name = e_message.split('"')[1]
                     else:
                         invalid_rule_name = ""
                     try:
-                        self.clean(rulefile, e_line, e_message, invalid_rule_name)
+                        f_lines, _ = self.clean(f_lines, e_line, e_message, invalid_rule_name)
                     except Exception as ve:
                         raise ve
 
@@ -126,3 +166,9 @@ class YaraValidator(object):
                     raise e
 
                 continue
+
+        if change:
+            with open(rulefile, 'w') as f:
+                f.writelines(f_lines)
+
+        return change